@@ -11,8 +11,7 @@
     For more information on the PQ-Gram algorithm, please see the README.
 """
 
-import pqgrams.tree, copy
-import functools
+import pqgrams.tree
 import collections
 import itertools
 
@@ -20,9 +19,18 @@ import itertools
 class Profile(object):
     """
         Represents a PQ-Gram Profile, which is a list of PQ-Grams. Each PQ-Gram is represented by a
-        deque. This class relies on the tree.Node classe.
+        tuple of p+q labels. This class relies on the tree.Node classe.
+
+        Every distinct PQ-Gram is also interned to a single integer id shared by all Profiles, and
+        self.counts maps each id to the number of times its PQ-Gram occurs, so that comparing two
+        Profiles only has to look up integers. The id table lives as long as the process and keeps
+        every distinct PQ-Gram it has seen. Ids are only meaningful within the process, so pickled
+        Profiles store their PQ-Grams and are interned again when they are loaded.
     """
 
+    _intern = dict()
+    _next_id = itertools.count()
+
     def __init__(self, root, p=2, q=3):
         """
             Builds the PQ-Gram Profile of the given tree, using the p and q parameters specified.
@@ -32,30 +40,76 @@ class Profile(object):
             invalid.
         """
         super(Profile, self).__init__()
-        ancestors = collections.deque('*'*p, maxlen=p)
+        ancestors = ('*',)*p
         self.list = list()
 
-        self.profile(root, p, q, ancestors)
-        self.sort()
+        self.profile(root, q, ancestors)
+        self.count()
 
-    def profile(self, root, p, q, ancestors):
+    def profile(self, root, q, ancestors):
         """
-            Recursively builds the PQ-Gram profile of the given subtree. This method should not be called
-            directly and is called from __init__.
+            Builds the PQ-Gram profile of the given subtree. This method should not be called directly
+            and is called from __init__. The ancestors tuple holds the p labels above root, which also
+            fixes p for the whole walk.
+
+            The tree is walked depth first with an explicit stack rather than by recursion, so deep
+            trees do not hit the recursion limit. Each stack entry holds a node's ancestors window, its
+            q siblings window and an iterator over its remaining children. Both windows are tuples
+            that are never modified, so an entry pushed for a child shares nothing mutable with its
+            parent's entry.
         """
-        ancestors.append(root.label)
-        siblings = collections.deque('*'*q, maxlen=q)
+        ancestors = ancestors[1:] + (root.label,)
+        siblings = ('*',)*q
+
+        grams = self.list
 
         if(len(root.children) == 0):
-            self.append(itertools.chain(ancestors, siblings))
-        else:
-            for child in root.children:
-                siblings.append(child.label)
-                self.append(itertools.chain(ancestors, siblings))
-                self.profile(child, p, q, copy.copy(ancestors))
-            for i in range(q-1):
-                siblings.append("*")
-                self.append(itertools.chain(ancestors, siblings))
+            grams.append(ancestors + siblings)
+            return
+
+        stack = [(ancestors, siblings, iter(root.children))]
+        while stack:
+            ancestors, siblings, children = stack[-1]
+            for child in children:
+                siblings = siblings[1:] + (child.label,)
+                grams.append(ancestors + siblings)
+                if(len(child.children) == 0):
+                    grams.append(ancestors[1:] + (child.label,) + ('*',)*q)
+                else:
+                    stack[-1] = (ancestors, siblings, children)
+                    stack.append((ancestors[1:] + (child.label,), ('*',)*q, iter(child.children)))
+                    break
+            else:
+                stack.pop()
+                for i in range(q-1):
+                    siblings = siblings[1:] + ("*",)
+                    grams.append(ancestors + siblings)
+
+    @classmethod
+    def intern(cls, grams):
+        """
+            Returns the integer ids of the given PQ-Grams, assigning new ids to PQ-Grams that have not
+            been seen before. Ids are shared by every Profile, so equal ids mean equal PQ-Grams. A new
+            id is assigned by a single setdefault call, so threads building Profiles concurrently
+            cannot give the same id to different PQ-Grams.
+        """
+        ids = cls._intern
+        next_id = cls._next_id
+        result = list()
+        for gram in grams:
+            gram_id = ids.get(gram)
+            if gram_id is None:
+                gram_id = ids.setdefault(gram, next(next_id))
+            result.append(gram_id)
+        return result
+
+    def count(self):
+        """
+            Counts the interned ids of the PQ-Grams in this Profile. This method should not be called
+            directly and is called from __init__ and when a Profile is unpickled.
+        """
+        self.counts = collections.Counter(self.intern(self.list))
+        self.id_range = (min(self.counts), max(self.counts))
 
     def edit_distance(self, other):
         """
@@ -68,47 +122,35 @@ class Profile(object):
     def intersection(self, other):
         """
             Computes the set intersection of two PQ-Gram Profiles and returns the number of
-            elements in the intersection.
+            elements in the intersection. PQ-Grams that occur several times count as many times as
+            they occur in both Profiles. Only the PQ-Grams of the Profile with fewer distinct
+            PQ-Grams are looked up in the other. Ids are handed out in the order PQ-Grams are first
+            seen, so Profiles whose id ranges do not overlap share no PQ-Gram at all.
         """
-        intersect = 0.0
-        i = j = 0
-        maxi = len(self)
-        maxj = len(other)
-        while i < maxi and j < maxj:
-            intersect += self.gram_edit_distance(self[i], other[j])
-            if self[i] == other[j]:
-                i += 1
-                j += 1
-            elif self[i] < other[j]:
-                i += 1
-            else:
-                j += 1
+        if self.id_range[1] < other.id_range[0] or other.id_range[1] < self.id_range[0]:
+            return 0
+        sc = self.counts
+        oc = other.counts
+        if len(sc) > len(oc):
+            sc, oc = oc, sc
+        lookup = oc.get
+        intersect = 0
+        for gram, count in sc.items():
+            other_count = lookup(gram)
+            if other_count:
+                intersect += count if count < other_count else other_count
         return intersect
 
-    @functools.lru_cache()
-    def gram_edit_distance(self, gram1, gram2):
-        """
-            Computes the edit distance between two different PQ-Grams. If the two PQ-Grams are the same
-            then the distance is 1.0, otherwise the distance is 0.0. Changing this will break the
-            metrics of the algorithm.
-        """
-        distance = 0.0
-        if gram1 == gram2:
-            distance = 1.0
-        return distance
-
-    def sort(self):
-        """
-            Sorts the PQ-Grams by the concatenation of their labels. This step is automatically performed
-            when a PQ-Gram Profile is created to ensure the intersection algorithm functions properly and
-            efficiently.
-        """
-        self.list.sort(key=lambda x: ''.join(x))
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['counts']
+        del state['id_range']
+        return state
 
-    def append(self, value):
-        self.list.append(tuple(value))
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.count()
 
-    @functools.lru_cache(maxsize=2)
     def __len__(self):
         return len(self.list)
 
@@ -118,9 +160,23 @@ class Profile(object):
     def __str__(self):
         return str(self.list)
 
-    @functools.lru_cache(maxsize=32)
     def __getitem__(self, key):
         return self.list[key]
 
     def __iter__(self):
         return iter(self.list)
+
+
+def pairwise_distances(profiles):
+    """
+        Computes the edit distance between every pair of the given PQ-Gram Profiles and returns it as a
+        list of rows, so that result[i][j] is profiles[i].edit_distance(profiles[j]). Since the edit
+        distance is symmetric, each pair is only computed once.
+    """
+    profiles = list(profiles)
+    distances = [[0.0]*len(profiles) for _ in profiles]
+    for i, profile1 in enumerate(profiles):
+        row = distances[i]
+        for j in range(i+1, len(profiles)):
+            row[j] = distances[j][i] = profile1.edit_distance(profiles[j])
+    return distances
@@ -9,7 +9,7 @@
 """
 
 import PQGram, tree
-import unittest, random, itertools
+import unittest, random, itertools, collections, pickle
 from pstats import Stats
 import cProfile
 random.seed(1)
@@ -24,17 +24,7 @@ class ProfileCheck(unittest.TestCase):
             Ensure that two different PQ-Gram Profile are actually the same. Used in later tests to
             compare dynamically created Profiles against preset Profiles.
         """
-        if len(profile1) != len(profile2) or len(profile1[0]) != len(profile2[0]):
-            return False
-        for gram1 in profile1:
-            contains = False
-            for gram2 in profile2:
-                if gram1 == gram2:
-                    contains = True
-                    break
-            if contains == False:
-                return False
-        return True
+        return collections.Counter(tuple(g) for g in profile1) == collections.Counter(tuple(g) for g in profile2)
 
     def setUp(self):
         self.p = 2
@@ -127,7 +117,8 @@ class ProfileCheck(unittest.TestCase):
         """x.edit_distance(y) should always return a value between 0 and 1"""
         for profile1 in self.profiles:
             for profile2 in self.profiles:
-                self.assertTrue(profile1.edit_distance(profile2) <= 1.0 and profile1.edit_distance(profile2) >= 0)
+                edit_distance = profile1.edit_distance(profile2)
+                self.assertTrue(0 <= edit_distance <= 1.0)
 
 #    def testTriangleInequality(self):
 #        """The triangle inequality should hold true for any three trees"""
@@ -136,6 +127,44 @@ class ProfileCheck(unittest.TestCase):
 #                for profile3 in self.profiles:
 #                    self.assertTrue(profile1.edit_distance(profile3) <= profile1.edit_distance(profile2) + profile2.edit_distance(profile3))
 
+    def testPairwiseDistances(self):
+        """pairwise_distances should agree with the PQ-Gram distance of every pair"""
+        distances = PQGram.pairwise_distances(self.profiles)
+        for i, profile1 in enumerate(self.profiles):
+            for j, profile2 in enumerate(self.profiles):
+                common = collections.Counter(profile1.list) & collections.Counter(profile2.list)
+                expected = 1.0 - 2.0*sum(common.values())/(len(profile1) + len(profile2))
+                self.assertAlmostEqual(distances[i][j], expected)
+
+    def testDeepTree(self):
+        """Profiles of trees deeper than the recursion limit should still be built"""
+        root = node = tree.Node("a")
+        for i in range(5000):
+            node = node.addkid(tree.Node("b")).children[0]
+        profile = PQGram.Profile(root, self.p, self.q)
+        self.assertEqual(len(profile), 5000*self.q + 1)
+        self.assertEqual(profile.edit_distance(profile), 0)
+
+    def testPickle(self):
+        """A pickled Profile should keep its PQ-Grams and distances when loaded by another process"""
+        self.profiles[0].note = "kept"
+        pickled = [pickle.dumps(profile) for profile in self.profiles]
+        expected = PQGram.pairwise_distances(self.profiles)
+
+        # Start from an empty id table, as a fresh process would
+        saved = PQGram.Profile._intern, PQGram.Profile._next_id
+        PQGram.Profile._intern, PQGram.Profile._next_id = dict(), itertools.count()
+        try:
+            rebuilt = [PQGram.Profile(tree1, self.p, self.q) for tree1 in reversed(self.trees)][::-1]
+            loaded = [pickle.loads(data) for data in pickled]
+            self.assertEqual(loaded[0].note, "kept")
+            for i, profile1 in enumerate(loaded):
+                self.assertEqual(profile1.list, self.profiles[i].list)
+                for j, profile2 in enumerate(rebuilt):
+                    self.assertEqual(profile1.edit_distance(profile2), expected[i][j])
+        finally:
+            PQGram.Profile._intern, PQGram.Profile._next_id = saved
+
     def testIdentity(self):
         """x.edit_distance(x) should always be 0"""
         for profile in self.profiles: